@@ -1,10 +1,18 @@
+import array
 import asyncio
 import logging
-import json
-import yfinance as yf
-from telegram import Bot, Update
+import mmap
+import sqlite3
+import random
+import time
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+import aiohttp
+import orjson
+from telegram import Update
+from telegram.error import BadRequest, Forbidden, RetryAfter
 from telegram.ext import Application, CommandHandler
-from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import os
 from dotenv import load_dotenv
 
@@ -20,60 +28,332 @@ TELEGRAM_API_KEY = os.getenv('TELEGRAM_API_KEY')
 if not TELEGRAM_API_KEY:
     raise ValueError("TELEGRAM_API_KEY environment variable is not set!")
 
-# Initialize empty set for subscribers and define file path
+# Subscriber storage: SQLite database, plus the JSON file used by older versions
+SUBSCRIBERS_DB = "subs.db"
 SUBSCRIBERS_FILE = "subscribers.json"
 
+class SubscriberStore:
+    """Subscriber chat IDs persisted in SQLite.
+
+    An in-memory set serves membership checks, and a packed int64 array serves
+    iteration during broadcasts. Like the price cache, the store is only safe to
+    use from the bot's event loop thread; sqlite's check_same_thread is left on
+    so any use from another thread fails loudly instead of racing.
+    """
+
+    def __init__(self, path):
+        # Autocommit mode: each add/remove is a single-row write
+        self._conn = sqlite3.connect(path, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA mmap_size=268435456")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS subscribers (chat_id INTEGER PRIMARY KEY)")
+        self._ids = {row[0] for row in self._conn.execute("SELECT chat_id FROM subscribers")}
+        self._packed = array.array('q', self._ids)
+
+    def add(self, chat_id):
+        if chat_id not in self._ids:
+            self._conn.execute("INSERT OR IGNORE INTO subscribers (chat_id) VALUES (?)", (chat_id,))
+            self._ids.add(chat_id)
+            self._packed.append(chat_id)
+
+    def remove(self, chat_id):
+        self.remove_many((chat_id,))
+
+    def remove_many(self, chat_ids):
+        chat_ids = [c for c in chat_ids if c in self._ids]
+        if not chat_ids:
+            return
+        with self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("DELETE FROM subscribers WHERE chat_id = ?", ((c,) for c in chat_ids))
+        self._ids.difference_update(chat_ids)
+        # Removals are rare, so rebuild rather than search the array. Assigning a
+        # new array also keeps any iteration in progress valid.
+        self._packed = array.array('q', self._ids)
+
+    def __contains__(self, chat_id):
+        return chat_id in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        return iter(self._packed)
+
+    def close(self):
+        self._conn.close()
+
+def _read_legacy_subscribers():
+    """Parse the legacy JSON subscribers file, memory-mapping it to avoid a full read."""
+    with open(SUBSCRIBERS_FILE, 'rb') as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Empty files can't be mapped, and some platforms lack mmap support
+            return orjson.loads(f.read() or b"[]")
+        with mm, memoryview(mm) as view:
+            return orjson.loads(view)
+
 def load_subscribers():
-    """Load subscribers from file."""
+    """Open the subscriber database, importing the legacy JSON file if present."""
+    store = SubscriberStore(SUBSCRIBERS_DB)
     try:
-        with open(SUBSCRIBERS_FILE, 'r') as f:
-            return set(json.load(f))
+        legacy = _read_legacy_subscribers()
     except FileNotFoundError:
-        return set()
-
-def save_subscribers(subs):
-    """Save subscribers to file."""
-    with open(SUBSCRIBERS_FILE, 'w') as f:
-        json.dump(list(subs), f)
+        return store
+    for chat_id in legacy:
+        store.add(chat_id)
+    # Keep the old file around but make sure it is only imported once
+    os.replace(SUBSCRIBERS_FILE, SUBSCRIBERS_FILE + ".migrated")
+    logger.info(f"Imported {len(legacy)} subscribers from {SUBSCRIBERS_FILE}")
+    return store
 
 # Load existing subscribers
 subscribers = load_subscribers()
 
-# Initialize Telegram bot
-bot = Bot(token=TELEGRAM_API_KEY)
-
-async def get_coffee_price():
-    """Fetches the latest coffee price from Yahoo Finance."""
-    ticker = "KC=F"  # Coffee Futures symbol
-    coffee = yf.Ticker(ticker)
-    # Get data for the last 5 days to ensure we have the last trading day
-    data = coffee.history(period="5d")
-
-    if not data.empty:
-        price_per_pound = data["Close"].iloc[-1] / 100  # Convert cents to dollars
-        price_per_kg = price_per_pound * 2.20462  # Convert price from per pound to per kg
-        last_date = data.index[-1].strftime("%Y-%m-%d")
-        return f"☕ Coffee Price (as of {last_date}): ${price_per_kg:.3f} per kg"
+# Daily broadcast limits: Telegram allows ~30 msg/s per bot, so stay a little under it
+BROADCAST_RATE = 25  # Messages started per second
+BROADCAST_CONCURRENCY = 25  # Worker tasks, i.e. sends in flight at once
+BROADCAST_MAX_ATTEMPTS = 3  # Per chat, when Telegram answers with RetryAfter
+
+# Price fetch constants
+_TICKER = "KC=F"  # Coffee Futures symbol, quoted in cents per pound
+_CHART_URL = "https://query1.finance.yahoo.com/v8/finance/chart/{}?range=5d&interval=1d"
+_HEADERS = {"User-Agent": "Mozilla/5.0"}
+_TIMEOUT = aiohttp.ClientTimeout(total=10)
+_LB_TO_KG = 2.20462  # Pounds per kilogram
+_CENTS_PER_LB_TO_USD_PER_KG = _LB_TO_KG / 100  # Cents/lb quote to $/kg in one multiply
+_MSG_TMPL = "☕ Coffee Price (as of {}): ${:.3f} per kg".format
+
+# Pooled HTTP session, created lazily on the bot's event loop
+_http_session = None
+
+def _get_session():
+    """Returns the pooled HTTP session, creating it if needed."""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(limit=8, keepalive_timeout=60)
+        _http_session = aiohttp.ClientSession(connector=connector, headers=_HEADERS, timeout=_TIMEOUT)
+    return _http_session
+
+async def close_http_session():
+    """Closes the pooled HTTP session."""
+    global _http_session
+    if _http_session is not None:
+        await _http_session.close()
+        _http_session = None
+
+# Cache of the last successfully fetched price message,
+# along with the validators Yahoo sent for it, used for conditional requests
+_PRICE_CACHE = {"msg": None, "ts": 0.0, "ttl": 0, "failed_ts": 0.0, "etag": None, "last_modified": None}
+_CACHE_TTL = 900  # 15 minutes
+_CACHE_TTL_AFTER_BROADCAST = 3600  # The broadcast price stays current for the evening
+_FAILURE_TTL = 60  # After a failed fetch, serve the stale price this long before retrying
+_price_fetch = None  # In-flight fetch task shared by concurrent callers
+_broadcast_lock = asyncio.Lock()
+
+def _is_transient(exc):
+    """Returns True if exc is worth retrying (network errors, timeouts, 429 and 5xx)."""
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status == 429 or exc.status >= 500
+    return isinstance(exc, (aiohttp.ClientError, asyncio.TimeoutError))
+
+def _retry_after(exc):
+    """Returns the Retry-After delay in seconds from a 429 response, if any."""
+    if isinstance(exc, aiohttp.ClientResponseError) and exc.status == 429 and exc.headers:
+        try:
+            return float(exc.headers.get("Retry-After", ""))
+        except ValueError:
+            return None
+    return None
+
+async def _with_backoff(fn, max_retries=3, base=1.0, cap=30.0, jitter=0.5):
+    """Awaits fn(), retrying transient failures with capped exponential backoff and jitter."""
+    for attempt in range(max_retries):
+        try:
+            return await fn()
+        except Exception as e:
+            # Hard failures (404, bad payload, ...) won't improve on retry
+            if not _is_transient(e) or attempt == max_retries - 1:
+                raise
+            delay = _retry_after(e)
+            if delay is None:
+                delay = min(base * 2 ** attempt, cap) * (1 + random.random() * jitter)
+            else:
+                delay = min(delay, cap)
+            logger.warning(f"Price fetch attempt {attempt + 1} failed ({e}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+async def _fetch_chart_price(ticker, etag=None, last_modified=None):
+    """Fetches the last price for ticker directly from the Yahoo chart API.
+
+    Returns (price, date, etag, last_modified), or None if the server reports
+    the data unchanged since the given validators.
+    """
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    async with _get_session().get(_CHART_URL.format(ticker), headers=headers) as r:
+        if r.status == 304:
+            return None
+        r.raise_for_status()
+        data = orjson.loads(await r.read())
+        etag, last_modified = r.headers.get("ETag"), r.headers.get("Last-Modified")
+    meta = data["chart"]["result"][0]["meta"]
+    price = meta.get("regularMarketPrice")
+    # Expired or delisted contracts come back with a null price
+    if price is None:
+        raise ValueError(f"No market price returned for {ticker}")
+    last_date = datetime.fromtimestamp(meta["regularMarketTime"], tz=timezone.utc)
+    return price, last_date, etag, last_modified
+
+async def _fetch_coffee_price():
+    """Fetches the latest coffee price from Yahoo Finance, or None on failure."""
+    # Only revalidate when there is a cached message to fall back on
+    if _PRICE_CACHE["msg"]:
+        etag, last_modified = _PRICE_CACHE["etag"], _PRICE_CACHE["last_modified"]
     else:
-        return "Could not fetch coffee price. Please try again later."
+        etag = last_modified = None
+    try:
+        result = await _with_backoff(lambda: _fetch_chart_price(_TICKER, etag, last_modified))
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError, IndexError, TypeError) as e:
+        logger.warning(f"Coffee price fetch failed: {e}")
+        return None
+    if result is None:
+        # 304 Not Modified: the cached message is still current
+        return _PRICE_CACHE["msg"]
+    close_cents, last_date, etag, last_modified = result
+
+    price_per_kg = close_cents * _CENTS_PER_LB_TO_USD_PER_KG
+    message = _MSG_TMPL(last_date.strftime("%Y-%m-%d"), price_per_kg)
+    _PRICE_CACHE["etag"] = etag
+    _PRICE_CACHE["last_modified"] = last_modified
+    return message
+
+async def _refresh_price():
+    """Fetches the price into the cache. Returns True on success."""
+    message = await _fetch_coffee_price()
+    if message:
+        _PRICE_CACHE["msg"] = message
+        _PRICE_CACHE["ts"] = time.time()
+        _PRICE_CACHE["ttl"] = _CACHE_TTL
+        return True
+    _PRICE_CACHE["failed_ts"] = time.time()
+    return False
+
+async def get_coffee_price(ttl=_CACHE_TTL, refresh=False):
+    """Returns the coffee price message, reusing a recent fetch when possible.
+
+    A successfully fetched (or revalidated) price is cached for ttl seconds.
+    With refresh=True the cache is always revalidated against Yahoo first.
+    """
+    global _price_fetch
+    now = time.time()
+    if not refresh and _PRICE_CACHE["msg"]:
+        if now - _PRICE_CACHE["ts"] < _PRICE_CACHE["ttl"]:
+            return _PRICE_CACHE["msg"]
+        # Yahoo just failed; don't start another retry cycle for every caller
+        if now - _PRICE_CACHE["failed_ts"] < _FAILURE_TTL:
+            return _PRICE_CACHE["msg"]
 
-async def send_daily_price():
+    # Concurrent callers all await the same fetch instead of each hitting Yahoo.
+    # Shielded so a cancelled caller doesn't cancel it for the others.
+    if _price_fetch is None or _price_fetch.done():
+        _price_fetch = asyncio.create_task(_refresh_price())
+    if await asyncio.shield(_price_fetch):
+        _PRICE_CACHE["ttl"] = max(_PRICE_CACHE["ttl"], ttl)
+
+    # Fall back to the last known price, however old, rather than failing outright
+    if _PRICE_CACHE["msg"]:
+        return _PRICE_CACHE["msg"]
+    return "Could not fetch coffee price. Please try again later."
+
+async def send_daily_price(bot):
     """Fetches coffee price and sends it to all subscribers daily."""
-    message = await get_coffee_price()
-    for chat_id in subscribers:
-        await bot.send_message(chat_id=chat_id, text=message)
-    logger.info(f"Daily price update sent to {len(subscribers)} subscribers.")
+    # Guard against back-to-back scheduler misfires overlapping
+    if _broadcast_lock.locked():
+        logger.warning("Daily price update already in progress, skipping.")
+        return
+    async with _broadcast_lock:
+        await _broadcast_price(bot)
+
+async def _broadcast_price(bot):
+    """Fetches the price once and sends that same message to every subscriber."""
+    # Revalidate (a cheap 304 if unchanged) so the hour of caching that lets
+    # /coffeeprice reuse the broadcast price starts now. A failed fetch leaves
+    # the stale fallback's TTL untouched.
+    message = await get_coffee_price(ttl=_CACHE_TTL_AFTER_BROADCAST, refresh=True)
+    loop = asyncio.get_running_loop()
+    next_slot = paused_until = loop.time()
+    dead = set()
+    sent = 0
+
+    async def _pace():
+        # Hand out send slots 1/BROADCAST_RATE seconds apart
+        nonlocal next_slot
+        while True:
+            now = loop.time()
+            slot = max(now, next_slot)
+            next_slot = slot + 1 / BROADCAST_RATE
+            if slot > now:
+                await asyncio.sleep(slot - now)
+            # A RetryAfter may have paused sending while this slot was waiting
+            if loop.time() >= paused_until:
+                return
 
-def job():
-    """Wrapper function to run send_daily_price() asynchronously."""
-    asyncio.run(send_daily_price())
+    async def _send(chat_id):
+        nonlocal next_slot, paused_until, sent
+        for attempt in range(BROADCAST_MAX_ATTEMPTS):
+            await _pace()
+            try:
+                await bot.send_message(chat_id=chat_id, text=message)
+                sent += 1
+                return
+            except RetryAfter as e:
+                if attempt == BROADCAST_MAX_ATTEMPTS - 1:
+                    raise
+                # The flood limit is per bot, so hold back every pending send
+                paused_until = max(paused_until, loop.time() + float(e.retry_after))
+                next_slot = max(next_slot, paused_until)
+            except Forbidden:
+                # User blocked the bot; drop them from the subscriber list
+                dead.add(chat_id)
+                return
+            except BadRequest as e:
+                # Chat was deleted or never existed; retrying it would fail forever
+                if "chat not found" in str(e).lower():
+                    dead.add(chat_id)
+                    return
+                raise
+
+    async def _worker(chat_ids):
+        for chat_id in chat_ids:
+            # Skip anyone who unsubscribed since the broadcast started
+            if chat_id not in subscribers:
+                continue
+            try:
+                await _send(chat_id)
+            except Exception as e:
+                logger.warning(f"Failed to send daily price update to {chat_id}: {e}")
+
+    # A fixed pool of workers shares one iterator, so memory stays flat
+    # however many subscribers there are
+    chat_ids = iter(subscribers)
+    await asyncio.gather(*(_worker(chat_ids) for _ in range(BROADCAST_CONCURRENCY)))
+
+    if dead:
+        subscribers.remove_many(dead)
+        logger.info(f"Pruned {len(dead)} dead subscribers.")
+    logger.info(f"Daily price update sent to {sent} subscribers.")
 
 # Telegram Command Handlers
 async def start(update: Update, context):
     """Handles the /start command."""
     chat_id = update.message.chat_id
     subscribers.add(chat_id)
-    save_subscribers(subscribers)
     await update.message.reply_text("Welcome! You've been subscribed to daily coffee price updates. Use /coffeeprice to get the latest coffee price.\nUse /unsubscribe to stop receiving daily updates.")
 
 async def price(update: Update, context):
@@ -86,7 +366,6 @@ async def unsubscribe(update: Update, context):
     chat_id = update.message.chat_id
     if chat_id in subscribers:
         subscribers.remove(chat_id)
-        save_subscribers(subscribers)
         await update.message.reply_text("You've been unsubscribed from daily updates.")
     else:
         await update.message.reply_text("You're not currently subscribed to updates.")
@@ -96,9 +375,33 @@ async def help_command(update: Update, context):
     help_text = "Available commands:\n/start - Start the bot and subscribe to updates\n/coffeeprice - Get coffee price\n/unsubscribe - Stop receiving daily updates\n/help - Show this help message"
     await update.message.reply_text(help_text)
 
+# Daily updates run on the bot's own event loop. The subscriber store, price
+# cache and locks are not thread-safe, so the job must never move to a thread.
+ROME_TZ = ZoneInfo("Europe/Rome")
+scheduler = AsyncIOScheduler(timezone=ROME_TZ)
+
+async def post_init(app):
+    """Starts the scheduler once the bot's event loop is running."""
+    scheduler.start()
+    logger.info("Scheduler started for daily updates (weekdays at 20:00 Rome time)")
+
+async def post_shutdown(app):
+    """Stops the scheduler and closes the HTTP session and subscriber database on exit."""
+    scheduler.shutdown(wait=False)
+    await close_http_session()
+    subscribers.close()
+
 # Initialize the Telegram bot application
 def main():
-    app = Application.builder().token(TELEGRAM_API_KEY).build()
+    app = (
+        Application.builder()
+        .token(TELEGRAM_API_KEY)
+        # Handle updates concurrently so a slow /coffeeprice doesn't hold up other commands
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Add command handlers
     app.add_handler(CommandHandler("start", start))
@@ -106,16 +409,13 @@ def main():
     app.add_handler(CommandHandler("help", help_command))
     app.add_handler(CommandHandler("unsubscribe", unsubscribe))
 
-    # Start APScheduler
-    scheduler = BackgroundScheduler()
-    # Schedule for 20:00 Rome time (2:00 PM ET + 6 hours)
-    scheduler.add_job(job, "cron", 
+    # Schedule for 20:00 Rome time (2:00 PM ET + 6 hours); started in post_init
+    scheduler.add_job(send_daily_price, "cron",
+                     args=[app.bot],
                      day_of_week='0-4',  # Monday through Friday
                      hour=20,            # 8:00 PM Rome time (after US market close)
                      minute=0,
-                     timezone='Europe/Rome')
-    scheduler.start()
-    logger.info("Scheduler started for daily updates (weekdays at 20:00 Rome time)")
+                     timezone=ROME_TZ)
 
     # Run the bot
     app.run_polling()